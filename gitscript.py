@@ -17,7 +17,8 @@ REPO_PATH   = "/home/sig07/website_nuevo"
 BRANCH      = "main"
 
 # Patrones a ignorar (pero OJO: aquí ya NO está *.png)
-IGNORE_LINES = [
+# Tupla inmutable: conserva el orden en que se escriben en .gitignore
+IGNORE_LINES = (
     ".venv/",
     "__pycache__/",
     "*.nc",
@@ -37,7 +38,7 @@ IGNORE_LINES = [
     "ecmwf_out/",
     "prcp_matrix.json",
     "prcp/prcp_matrix.json",
-]
+)
 
 
 def ensure_repo(path: str) -> Repo:
@@ -49,6 +50,11 @@ def ensure_repo(path: str) -> Repo:
         with repo.config_writer() as cw:
             cw.set_value("user", "name",  "Julio (website_nuevo)")
             cw.set_value("user", "email", "you@example.com")
+    # Refresco del índice en paralelo (status/add sobre miles de PNG);
+    # solo se escribe .git/config si index.threads aún no está definido.
+    if not repo.config_reader().has_option("index", "threads"):
+        with repo.config_writer() as cw:
+            cw.set_value("index", "threads", "true")
     return repo
 
 
@@ -61,8 +67,7 @@ def append_unique_lines(file_path: str, lines):
     to_add = [ln for ln in lines if ln not in existing]
     if to_add:
         with open(file_path, "a" if existing else "w", encoding="utf-8") as f:
-            for ln in to_add:
-                f.write(f"{ln}\n")
+            f.write("\n".join(to_add) + "\n")
         return True
     return False
 
@@ -90,12 +95,13 @@ if changed_ignore:
     repo.index.add([gi_path])
 
 # Si no hay cambios en el árbol de trabajo, no hacemos nada
-if not repo.is_dirty(untracked_files=True):
+# (una sola llamada a git status en vez de recorrer el árbol desde Python)
+if not git.status("--porcelain"):
     print("No hay cambios que subir.")
     raise SystemExit(0)
 
 # Stage de TODO lo que no esté ignorado por .gitignore
-git.add(all=True)
+git.add("-A", "--", REPO_PATH)
 
 # ¿Ya existe al menos un commit?
 has_commits = True
@@ -1,14 +1,21 @@
 #!/usr/bin/env python3
 import argparse
-import json
+import hashlib
 import os
+import tempfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
+import numexpr as ne
 import numpy as np
+import orjson
 import pandas as pd
 import xarray as xr
-
-# wrf-python helpers
-from wrf import getvar, ll_to_xy, to_np, latlon_coords
+from dask.distributed import Client
+from netCDF4 import Dataset
+from pyproj import CRS, Transformer
+from scipy.spatial import cKDTree
 
 # -----------------------
 # Ciudades ~50 (nombre, lat, lon)
@@ -66,6 +73,12 @@ CITIES = [
     ("Chilpancingo", 17.551, -99.503),
 ]
 
+# Variables crudas del wrfout que se leen para los meteogramas
+SLAB_VARS = ["T2", "U10", "V10", "Q2", "PSFC", "RAINC", "RAINNC"]
+# Attrs WRF que (junto con ny, nx) identifican la geometría de la grilla
+GRID_ATTRS = ("TRUELAT1", "TRUELAT2", "CEN_LAT", "CEN_LON", "MOAD_CEN_LAT",
+              "STAND_LON", "DX", "DY")
+
 def round3(x: float) -> float:
     return float(f"{x:.3f}")
 
@@ -75,43 +88,115 @@ def ensure_outdir(p: Path):
 def concat_time(wrf_paths):
     """
     Abre varios wrfout_* y concatena en el eje tiempo.
-    Mantiene variables necesarias, decodifica tiempos.
+    Ruta rápida: apertura en paralelo (dask), concatenación 'nested' por Time
+    sin chequeos de alineación de coordenadas; se decodifica al final.
     """
-    def _preprocess(ds):
-        # Mantén solo variables necesarias para bajar RAM (opcional)
-        keep = [v for v in ds.data_vars]
-        # No filtramos aquí para no romper wrf.getvar que usa campos auxiliares.
-        return ds
-
     ds = xr.open_mfdataset(
         wrf_paths,
-        combine='by_coords',
-        preprocess=_preprocess,
-        parallel=False,
+        combine='nested',
+        concat_dim='Time',
+        parallel=True,
+        data_vars='minimal',
+        coords='minimal',
+        compat='override',
+        decode_cf=False,
         engine='netcdf4',
-        decode_times=True
+        chunks={'Time': 1}
     )
-    return ds
+    return xr.decode_cf(ds)
+
+def latlon_vars(ds):
+    # 2D lat/lon (DataArrays, perezosos) de XLAT/XLONG (o XLAT_M/XLONG_M), sin getvar
+    lat_name = "XLAT" if "XLAT" in ds.variables else "XLAT_M"
+    lon_name = "XLONG" if "XLONG" in ds.variables else "XLONG_M"
+    lat = ds[lat_name]
+    lon = ds[lon_name]
+    if "Time" in lat.dims:
+        lat = lat.isel(Time=0)
+    if "Time" in lon.dims:
+        lon = lon.isel(Time=0)
+    return lat, lon
 
 def compute_latlon(ds):
-    # wrf-python: devuelve 2D lat/lon
-    lats, lons = latlon_coords(getvar(ds, "T2", timeidx=0))
-    return to_np(lats), to_np(lons)
+    lat, lon = latlon_vars(ds)
+    return lat.values, lon.values
+
+def lcc_from_attrs(ds) -> CRS:
+    """CRS LCC de la grilla WRF desde attrs (TRUELAT1/2, CEN_LAT, STAND_LON)."""
+    return CRS.from_proj4(
+        f"+proj=lcc +lat_1={float(ds.attrs['TRUELAT1'])} +lat_2={float(ds.attrs['TRUELAT2'])} "
+        f"+lat_0={float(ds.attrs['CEN_LAT'])} +lon_0={float(ds.attrs['STAND_LON'])} "
+        f"+ellps=WGS84 +units=m +no_defs"
+    )
+
+def project_grid(lats, lons, tf):
+    """Puntos de grilla proyectados a LCC (metros), como arrays X, Y."""
+    X, Y = tf.transform(lons, lats)
+    return np.asarray(X), np.asarray(Y)
+
+def build_tree(X, Y):
+    """
+    cKDTree (euclídeo) sobre los puntos de grilla proyectados a LCC (metros).
+    """
+    return cKDTree(np.c_[np.ravel(X), np.ravel(Y)])
 
-def nearest_ij(ds, lat, lon):
+def grid_index(ds, tf, cache_dir):
     """
-    Usa ll_to_xy (wrf) para obtener el punto de grilla más cercano.
+    lats, lons (2D) y cKDTree de la grilla. La geometría WRF no cambia entre
+    corridas: lat/lon y X/Y proyectados se guardan en un .npz (sin pickle) en
+    `cache_dir`, con una clave derivada de la proyección y el tamaño de la
+    grilla. El cKDTree se reconstruye desde X/Y (milisegundos). Un caché
+    ilegible o de otra grilla se recalcula y se sobrescribe.
     """
-    # getvar devuelve DataArray; usar T2 solo para sacar proyección
-    t2 = getvar(ds, "T2", timeidx=0)
-    j_i = ll_to_xy(ds, lat, lon, meta=False)  # (x, y) = (i, j)
-    i_idx = int(j_i[0])
-    j_idx = int(j_i[1])
-    # Asegura límites
-    ny, nx = t2.shape[-2], t2.shape[-1]
-    i_idx = max(0, min(nx-1, i_idx))
-    j_idx = max(0, min(ny-1, j_idx))
-    return j_idx, i_idx
+    ny, nx = ds.sizes["south_north"], ds.sizes["west_east"]
+    key = tuple(float(ds.attrs[k]) if k in ds.attrs else None for k in GRID_ATTRS) + (ny, nx)
+    digest = hashlib.sha1(repr(key).encode()).hexdigest()[:16]
+    cache_dir = Path(cache_dir)
+    npz_path = cache_dir / f"wrf_meteogram_index_{digest}.npz"
+
+    try:
+        with np.load(npz_path, allow_pickle=False) as f:
+            lats, lons, X, Y = f["lats"], f["lons"], f["X"], f["Y"]
+        if lats.shape == lons.shape == X.shape == Y.shape == (ny, nx):
+            # Esquinas de la grilla actual vs. caché: evita reutilizar otro dominio
+            lat, lon = latlon_vars(ds)
+            corners = np.ix_([0, -1], [0, -1])
+            lat_c = lat.isel({lat.dims[0]: [0, -1], lat.dims[1]: [0, -1]}).values
+            lon_c = lon.isel({lon.dims[0]: [0, -1], lon.dims[1]: [0, -1]}).values
+            if (np.allclose(lats[corners], lat_c, atol=1e-4)
+                    and np.allclose(lons[corners], lon_c, atol=1e-4)):
+                return lats, lons, build_tree(X, Y)
+        print(f"[WARN] Caché de grilla no coincide con este dominio ({npz_path}); se recalcula.")
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile) as e:
+        print(f"[WARN] Caché de grilla ilegible ({npz_path}): {e}; se recalcula.")
+
+    lats, lons = compute_latlon(ds)
+    X, Y = project_grid(lats, lons, tf)
+    # Escritura atómica: archivo temporal en el mismo directorio + os.replace.
+    # El caché es solo una optimización: si falla, se avisa y se sigue.
+    tmp_path = None
+    try:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix=npz_path.stem, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, lats=lats, lons=lons, X=X, Y=Y)
+        os.replace(tmp_path, npz_path)
+    except OSError as e:
+        print(f"[WARN] No se pudo guardar el caché de grilla ({npz_path}): {e}")
+        if tmp_path is not None:
+            Path(tmp_path).unlink(missing_ok=True)
+    return lats, lons, build_tree(X, Y)
+
+def nearest_ij(tree, tf, shape, lat, lon):
+    """
+    Punto de grilla más cercano en el plano LCC vía cKDTree.
+    """
+    x, y = tf.transform(lon, lat)
+    _, idx = tree.query([x, y])
+    j_idx, i_idx = np.unravel_index(idx, shape)
+    return int(j_idx), int(i_idx)
 
 def to_celsius(k):
     return k - 273.15
@@ -121,110 +206,108 @@ def wind_speed_kmh(u10, v10):
     spd = np.sqrt(u10**2 + v10**2)
     return spd * 3.6
 
-def rh2_percent(ds):
+def load_slab(ds):
     """
-    Intenta obtener humedad relativa a 2m con wrf.getvar('rh2').
-    Si falla, calcula aproximado usando T2 (K), Q2 (kg/kg) y PSFC (Pa).
+    Lee en memoria, en una sola pasada, solo las variables crudas necesarias.
+    Devuelve dict {nombre: array (T, ny, nx)}.
     """
-    try:
-        rh2 = getvar(ds, "rh2")  # [%]
-        return rh2
-    except Exception:
-        # Aproximación (Tetens); Q2 ~ razón de mezcla (kg/kg).
-        T2 = getvar(ds, "T2")  # K
-        Q2 = getvar(ds, "Q2")  # kg/kg
-        PSFC = getvar(ds, "PSFC")  # Pa
-
-        # presión en hPa
-        p_hpa = PSFC / 100.0
-        # temp en °C
-        T_c = T2 - 273.15
-
-        # presión de vapor de saturación (hPa) Tetens
-        es = 6.112 * np.exp((17.67 * T_c) / (T_c + 243.5))
-        # mezcla de saturación (kg/kg), usando aproximación: qs = 0.622 * es / (p - 0.378*es)
-        qs = 0.622 * es / (p_hpa - 0.378 * es)
-        # humedad relativa
-        rh = (Q2 / qs) * 100.0
-        rh = xr.where(rh < 0, 0, rh)
-        rh = xr.where(rh > 100, 100, rh)
-        return rh
-
-def rain_rate_mm_per_h(ds):
+    names = [v for v in SLAB_VARS if v in ds.data_vars]
+    slab = ds[names].load()
+    return {v: slab[v].values for v in names}
+
+def load_slab_nc(wrf_paths):
     """
-    mm/h a partir de acumulados (RAINC + RAINNC).
-    Si el paso de tiempo no es 1h, se normaliza a mm/h.
+    Igual que load_slab, pero leyendo directo con netCDF4 (sin xarray/dask):
+    una apertura por archivo y una sola concatenación en Time por variable.
     """
-    try:
-        rainc = getvar(ds, "RAINC")  # mm, acumulado convectivo
-    except Exception:
-        rainc = 0
-    try:
-        rainnc = getvar(ds, "RAINNC")  # mm, no convectivo
-    except Exception:
-        rainnc = 0
-
-    if isinstance(rainc, int):
-        rain_acc = rainnc
-    elif isinstance(rainnc, int):
-        rain_acc = rainc
-    else:
-        rain_acc = rainc + rainnc  # mm acumulados
-
-    # diferencia temporal
-    rain_diff = rain_acc.diff(dim=rain_acc.dims[0], label='upper')  # mm en Δt
-    # tiempo entre pasos (horas). Asume coord 'Time' (decodificada)
-    time = rain_acc[ rain_acc.dims[0] ].to_index()
-    # vector de horas entre pasos (al tamaño de diff)
-    dt_hours = []
-    for t0, t1 in zip(time[:-1], time[1:]):
-        dt = (pd.to_datetime(t1) - pd.to_datetime(t0)).total_seconds()/3600.0
-        dt_hours.append(dt if dt>0 else 1.0)
-    dt_hours = xr.DataArray(np.array(dt_hours), dims=[rain_diff.dims[0]])
-
-    rate = rain_diff / dt_hours  # mm/h
-    # igualamos longitud con time original insertando un 0 al inicio
-    rate_full = xr.concat([rate.isel({rate.dims[0]: 0})*0, rate], dim=rate.dims[0])
-    rate_full = rate_full.assign_coords({rate_full.dims[0]: rain_acc[rain_acc.dims[0]]})
-    return rate_full
-
-def extract_series(ds, j, i):
+    parts = {v: [] for v in SLAB_VARS}
+    for path in wrf_paths:
+        with Dataset(path) as nc:
+            nc.set_auto_mask(False)
+            for v in SLAB_VARS:
+                if v in nc.variables:
+                    parts[v].append(nc.variables[v][:])
+    return {v: np.concatenate(arrs) for v, arrs in parts.items() if arrs}
+
+def rh2_percent(slab):
+    """
+    Humedad relativa a 2m (%) sobre toda la grilla usando T2 (K), Q2 (kg/kg)
+    y PSFC (Pa). Es la misma aproximación de Tetens que usa wrf.getvar('rh2').
+    """
+    T2 = np.ascontiguousarray(slab["T2"])  # K
+    Q2 = np.ascontiguousarray(slab["Q2"])  # kg/kg
+    PSFC = np.ascontiguousarray(slab["PSFC"])  # Pa
+
+    # Aproximación (Tetens) fusionada con numexpr: un solo bucle C por bloques,
+    # sin arrays intermedios (T, ny, nx). Q2 ~ razón de mezcla (kg/kg).
+    rh = ne.evaluate(
+        "100.0 * Q2 / (0.622 * 6.112 * exp(17.67 * (T2 - 273.15) / ((T2 - 273.15) + 243.5))"
+        " / (PSFC / 100.0 - 0.378 * 6.112 * exp(17.67 * (T2 - 273.15) / ((T2 - 273.15) + 243.5))))"
+    )
+    np.clip(rh, 0, 100, out=rh)
+    return rh
+
+def rain_rate_mm_per_h(slab, times):
+    """
+    mm/h a partir de acumulados (RAINC + RAINNC), como array (T, ny, nx).
+    Si el paso de tiempo no es 1h, se normaliza a mm/h; el primer paso es 0.
+    Sin RAINC ni RAINNC en el wrfout la tasa es 0 (con aviso).
     """
-    Extrae series en el punto (j,i). Devuelve dict con arrays nativos de Python.
+    names = [v for v in ("RAINC", "RAINNC") if v in slab]  # convectivo / no convectivo
+    if not names:
+        print("[WARN] El wrfout no tiene RAINC ni RAINNC; precipitación = 0 mm/h.")
+        return np.zeros_like(slab["T2"])
+    R = slab[names[0]]
+    for v in names[1:]:
+        R = R + slab[v]  # mm acumulados
+
+    # diferencia temporal (mm en Δt), sin copias intermedias
+    dR = np.empty_like(R)
+    dR[0] = 0
+    np.subtract(R[1:], R[:-1], out=dR[1:])
+    # horas entre pasos (al tamaño de diff)
+    dt_hours = np.diff(times.astype('datetime64[s]')).astype('float32') / 3600.0
+    dt_hours[dt_hours <= 0] = 1.0
+    dR[1:] /= dt_hours[:, None, None]  # mm/h
+    return dR
+
+def decode_times(ds):
     """
-    # Temperatura 2m (°C)
-    T2 = getvar(ds, "T2")  # K
-    t2m = to_celsius(T2[:, j, i]).values
-
-    # Viento 10m (km/h)
-    U10 = getvar(ds, "U10")  # m/s
-    V10 = getvar(ds, "V10")  # m/s
-    wind = wind_speed_kmh(U10[:, j, i].values, V10[:, j, i].values)
-
-    # Humedad relativa 2m (%)
-    RH2 = rh2_percent(ds)
-    rh = RH2[:, j, i].values
-
-    # Precipitación mm/h
-    rain_rate = rain_rate_mm_per_h(ds)
-    tp = rain_rate[:, j, i].values
-
-    # Timestamps ISO (UTC)
-    timevar = getvar(ds, "times", meta=False)  # array de strings b'YYYY-MM-DD_HH:MM:SS'
-    # Convierte a ISO "YYYY-MM-DDTHH:MMZ"
-    ts = []
-    for t in to_np(timevar):
-        s = t.decode() if isinstance(t, (bytes, bytearray)) else str(t)
-        # WRF típicamente "YYYY-MM-DD_HH:MM:SS"
-        s = s.replace("_", "T") + "Z"
-        ts.append(s)
+    Decodifica Times de WRF ("YYYY-MM-DD_HH:MM:SS") sin bucles en Python:
+    el arreglo de caracteres (T, 19) se reinterpreta como |S19 en una sola vista.
+    Devuelve (datetime64[s], lista ISO UTC "YYYY-MM-DDTHH:MM:SSZ").
+    """
+    raw = ds["Times"].values
+    if raw.ndim == 2:  # (T, 19) dtype 'S1', sin concatenar por xarray
+        raw = np.ascontiguousarray(raw).view("S19").reshape(-1)
+    s = np.char.replace(raw.astype("U19"), "_", "T")
+    return s.astype("datetime64[s]"), np.char.add(s, "Z").tolist()
 
+def extract_series(t2c, wind, rh, tp, ts, j, i):
+    """
+    Extrae series en el punto (j,i) a partir de los campos completos ya
+    calculados (T, ny, nx). `ts` es la lista de timestamps ISO, común a
+    todas las ciudades. Devuelve dict con listas nativas de Python.
+    """
+    t2m = t2c[:, j, i]
+    wind = wind[:, j, i]
+    rh = rh[:, j, i]
+    tp = tp[:, j, i]
+
+    # Enteros (int16) solo con datos válidos: NaN/inf o fuera de rango se
+    # reportan como error de la ciudad en vez de publicar números sin sentido.
+    for name, serie in (("wind", wind), ("rh", rh)):
+        if not (np.isfinite(serie).all() and (np.abs(serie) < np.iinfo(np.int16).max).all()):
+            raise ValueError(f"serie '{name}' con valores no finitos o fuera de rango en (j={j}, i={i})")
+
+    # Redondeo vectorizado y conversión a listas en C (.tolist()).
+    # Los flotantes se redondean en float64: float32.tolist() daría 23.399999618530273.
     return {
         "timestamps": ts,
-        "t2m": [round(float(x), 1) for x in t2m],
-        "tp":  [round(float(x), 2) for x in tp],
-        "wind": [int(round(float(x))) for x in wind],
-        "rh":   [int(round(float(x))) for x in rh]
+        "t2m": np.round(t2m.astype(np.float64), 1).tolist(),
+        "tp":  np.round(tp.astype(np.float64), 2).tolist(),
+        "wind": np.rint(wind).astype(np.int16).tolist(),
+        "rh":   np.rint(rh).astype(np.int16).tolist()
     }
 
 def save_json(outdir: Path, lat: float, lon: float, data: dict):
@@ -232,57 +315,85 @@ def save_json(outdir: Path, lat: float, lon: float, data: dict):
     lon3 = round3(lon)
     outdir.mkdir(parents=True, exist_ok=True)
     path = outdir / f"{lat3},{lon3}.json"
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False)
+    path.write_bytes(orjson.dumps(data))
     return path
 
+def process_city(city, tree, tf, shape, fields, ts, outdir: Path):
+    """
+    Trabajo independiente por ciudad (consulta al árbol, recorte de series y
+    escritura del JSON). Solo lee `tree` y `fields`; devuelve la línea de log.
+    """
+    name, lat, lon = city
+    try:
+        j, i = nearest_ij(tree, tf, shape, lat, lon)
+        series = extract_series(*fields, ts, j, i)
+        path = save_json(outdir, lat, lon, series)
+        return f"[OK] {name:20s} → {path}"
+    except Exception as e:
+        return f"[ERR] {name}: {e}"
+
 def main():
     ap = argparse.ArgumentParser(description="Genera JSON de meteograma para ciudades desde wrfout_*")
     ap.add_argument("--wrf", nargs="+", required=True, help="Rutas a wrfout_* (acepta comodines si tu shell expande)")
     ap.add_argument("--outdir", default="data/meteogram/wrf", help="Directorio de salida (default: data/meteogram/wrf)")
     ap.add_argument("--cities_csv", default=None, help="CSV opcional con columnas name,lat,lon")
+    ap.add_argument("--reader", choices=("netcdf4", "xarray"), default="netcdf4",
+                    help="Lectura de variables crudas: netCDF4 directo (default) o xarray/dask")
+    ap.add_argument("--cache_dir", default=str(Path.home() / ".cache" / "wrf_meteogram"), help="Directorio del usuario para guardar/reutilizar lat/lon y X/Y de la grilla (default: ~/.cache/wrf_meteogram)")
     args = ap.parse_args()
 
-    wrf_paths = sorted(args.wrf)
-    if not wrf_paths:
-        raise SystemExit("No se encontraron archivos WRF (wrfout_*)")
-
-    outdir = Path(args.outdir)
-    ensure_outdir(outdir)
-
-    # Carga ciudades
-    cities = []
-    if args.cities_csv and Path(args.cities_csv).exists():
-        df = pd.read_csv(args.cities_csv)
-        for _, r in df.iterrows():
-            cities.append((str(r["name"]), float(r["lat"]), float(r["lon"])))
-    else:
-        cities = CITIES
-
-    print(f"[INFO] Abriendo {len(wrf_paths)} archivos WRF…")
-    ds = concat_time(wrf_paths)
-
-    # Validación rápida
-    time_len = ds.dims.get("Time") or ds.dims.get("time") or None
-    if not time_len:
-        print("[WARN] No se detectó dimensión temporal explícita; wrf.getvar manejará 'times' igualmente.")
-    else:
-        print(f"[INFO] Pasos de tiempo: {time_len}")
-
-    # Para ll_to_xy se usa ds completo. Calculamos una vez T2 para shape y proyección.
-    _ = getvar(ds, "T2", timeidx=0)
-
-    # Procesa ciudades
-    for name, lat, lon in cities:
-        try:
-            j, i = nearest_ij(ds, lat, lon)
-            series = extract_series(ds, j, i)
-            path = save_json(outdir, lat, lon, series)
-            print(f"[OK] {name:20s} → {path}")
-        except Exception as e:
-            print(f"[ERR] {name}: {e}")
-
-    print("[DONE] JSONs listos.")
+    # Cliente dask local (hilos) para abrir/decodificar wrfout_* en paralelo;
+    # el contexto lo cierra también si algo falla.
+    with Client(processes=False):
+        wrf_paths = sorted(args.wrf)
+        if not wrf_paths:
+            raise SystemExit("No se encontraron archivos WRF (wrfout_*)")
+
+        outdir = Path(args.outdir)
+        ensure_outdir(outdir)
+
+        # Carga ciudades
+        cities = []
+        if args.cities_csv and Path(args.cities_csv).exists():
+            df = pd.read_csv(args.cities_csv)
+            for _, r in df.iterrows():
+                cities.append((str(r["name"]), float(r["lat"]), float(r["lon"])))
+        else:
+            cities = CITIES
+
+        print(f"[INFO] Abriendo {len(wrf_paths)} archivos WRF…")
+        ds = concat_time(wrf_paths)
+
+        # Validación rápida
+        time_len = ds.sizes.get("Time") or ds.sizes.get("time") or None
+        if not time_len:
+            print("[WARN] No se detectó dimensión temporal explícita; se decodificará 'Times' igualmente.")
+        else:
+            print(f"[INFO] Pasos de tiempo: {time_len}")
+
+        # Índice espacial de la grilla (una vez) para buscar el punto más cercano
+        tf = Transformer.from_crs("EPSG:4326", lcc_from_attrs(ds), always_xy=True)
+        lats, lons, tree = grid_index(ds, tf, args.cache_dir)
+
+        # Campos completos (T, ny, nx): una sola lectura de las variables crudas
+        if args.reader == "netcdf4":
+            slab = load_slab_nc(wrf_paths)
+        else:
+            slab = load_slab(ds)
+        times, ts = decode_times(ds)  # ts idénticos para todas las ciudades
+        T2_full = to_celsius(slab["T2"])  # °C
+        WIND = wind_speed_kmh(slab["U10"], slab["V10"])  # km/h
+        RH = rh2_percent(slab)  # %
+        TP = rain_rate_mm_per_h(slab, times)  # mm/h
+
+        # Procesa ciudades en paralelo (árbol y campos son de solo lectura)
+        work = partial(process_city, tree=tree, tf=tf, shape=lats.shape,
+                       fields=(T2_full, WIND, RH, TP), ts=ts, outdir=outdir)
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
+            for msg in ex.map(work, cities):
+                print(msg)
+
+        print("[DONE] JSONs listos.")
 
 if __name__ == "__main__":
     main()
@@ -10,6 +10,7 @@ Ejemplo:
     --out tmp/tmean_20250919_00-24_4326.tif
 """
 import argparse
+import os
 from pathlib import Path
 from typing import Tuple
 
@@ -18,20 +19,28 @@ import xarray as xr
 import rioxarray as rxr  # noqa: F401
 from pyproj import CRS, Transformer
 from affine import Affine
+from rasterio.enums import Resampling
 
 
 # ------------------------ utilidades IO ------------------------
 
+# Bloques dask: pocas horas por bloque y teselas de 256x256 puntos
+WRF_CHUNKS = {"Time": 4, "south_north": 256, "west_east": 256}
+
+
 def open_wrf(wrf_path: str) -> xr.Dataset:
-    """Abrir wrfout probando backends comunes, sin decodificar tiempos."""
+    """
+    Abrir wrfout probando backends comunes, sin decodificar tiempos.
+    Con chunks explícitos (dask) para que la media temporal se haga por bloques.
+    """
     try:
-        return xr.open_dataset(wrf_path, engine="netcdf4", decode_times=False)
+        return xr.open_dataset(wrf_path, engine="netcdf4", decode_times=False, chunks=WRF_CHUNKS)
     except Exception as e1:
         try:
-            return xr.open_dataset(wrf_path, engine="h5netcdf", decode_times=False)
+            return xr.open_dataset(wrf_path, engine="h5netcdf", decode_times=False, chunks=WRF_CHUNKS)
         except Exception as e2:
             try:
-                return xr.open_dataset(wrf_path, engine="scipy", decode_times=False)
+                return xr.open_dataset(wrf_path, engine="scipy", decode_times=False, chunks=WRF_CHUNKS)
             except Exception as e3:
                 raise RuntimeError(
                     "No se pudo abrir el wrfout con netcdf4/h5netcdf/scipy.\n"
@@ -107,14 +116,25 @@ def get_latlon(ds: xr.Dataset) -> Tuple[xr.DataArray, xr.DataArray]:
 def axes_from_latlon(lat2d: xr.DataArray, lon2d: xr.DataArray, lcc: CRS) -> Tuple[np.ndarray, np.ndarray]:
     """
     Transforma mallas lat/lon -> X,Y (LCC) y devuelve ejes 1D coherentes con el orden de la matriz:
-      x_vec[j]  ~ mediana de X[:, j]
-      y_vec[i]  ~ mediana de Y[i, :]
+      x_vec[j]  ~ X[ny//2, j]
+      y_vec[i]  ~ Y[i, nx//2]
+    En la malla LCC de WRF las filas/columnas son monótonas, así que basta la fila/columna
+    central; si hay NaN se usa la mediana por columna/fila.
     Así el píxel [i, j] corresponde al centro (x_vec[j], y_vec[i]).
     """
     tf = Transformer.from_crs("EPSG:4326", lcc, always_xy=True)
-    X, Y = tf.transform(lon2d.values, lat2d.values)  # 2D en metros
-    x_vec = np.nanmedian(X, axis=0)  # tamaño = west_east
-    y_vec = np.nanmedian(Y, axis=1)  # tamaño = south_north
+    ny, nx = lat2d.shape
+    lon_flat = np.ascontiguousarray(lon2d.values).ravel()
+    lat_flat = np.ascontiguousarray(lat2d.values).ravel()
+    X, Y = tf.transform(lon_flat, lat_flat)  # en metros
+    X = np.asarray(X).reshape(ny, nx)
+    Y = np.asarray(Y).reshape(ny, nx)
+    if np.isnan(X).any() or np.isnan(Y).any():
+        x_vec = np.nanmedian(X, axis=0)  # tamaño = west_east
+        y_vec = np.nanmedian(Y, axis=1)  # tamaño = south_north
+    else:
+        x_vec = X[ny // 2, :]  # tamaño = west_east
+        y_vec = Y[:, nx // 2]  # tamaño = south_north
     return x_vec, y_vec
 
 
@@ -192,13 +212,21 @@ def tmean_24h_to_geotiff(wrf_path: str, hours: str, out_tif: str) -> None:
     except Exception:
         pass
 
-    # Reproyectar a EPSG:4326 (deja que rioxarray elija resolución)
-    da4326 = da.rio.reproject("EPSG:4326")
+    # Reproyectar a EPSG:4326 (deja que rioxarray elija resolución).
+    # float32 + warp multihilo de GDAL. La media por bloques se evalúa aquí.
+    da = da.astype("float32").compute()
+    da4326 = da.rio.reproject(
+        "EPSG:4326",
+        resampling=Resampling.bilinear,
+        num_threads=os.cpu_count(),
+        warp_mem_limit=512,
+    )
 
     # Guardar GeoTIFF
     out = Path(out_tif)
     out.parent.mkdir(parents=True, exist_ok=True)
-    da4326.rio.to_raster(out, dtype="float32")
+    da4326.rio.to_raster(out, dtype="float32", tiled=True, compress="DEFLATE",
+                         num_threads="all_cpus", BIGTIFF="IF_SAFER")
 
 
 # ------------------------ CLI ------------------------